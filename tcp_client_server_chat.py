@@ -4,73 +4,133 @@ Server-Client Chat System using TCP
 
 import asyncio
 import argparse
+import collections
+import concurrent.futures
+import socket
 import struct
-from datetime import datetime
+import time
 
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
-async def recv_formatted_data(reader, frmt):
+_I = struct.Struct('<i')
+_B = struct.Struct('<?')
+
+COALESCE_MS = 2  # how long broadcast frames may sit in the server's pending buffers
+
+_last_sec = 0
+_last_str = ''
+
+def _now_hms():
+    """
+    Formats the current time as HH:MM:SS, caching the result for the current second so
+    bursts of messages don't each pay for strftime.
+    """
+    global _last_sec, _last_str
+    sec = int(time.time())
+    if sec != _last_sec:
+        _last_sec = sec
+        _last_str = time.strftime('%H:%M:%S', time.localtime(sec))
+    return _last_str
+
+
+async def _recv_i(reader):
+    """
+    Receives a single 4-byte integer from the given reader.
+    """
+    return _I.unpack(await reader.readexactly(4))[0]
+
+
+async def _recv_bool(reader):
+    """
+    Receives a single boolean from the given reader.
+    """
+    return _B.unpack(await reader.readexactly(1))[0]
+
+
+def _send_i(writer, value):
     """
-    Receives struct-formatted data from the given reader according to the struct format given and
-    returns a tuple of values.
+    Sends a single 4-byte integer using the given writer.
     """
-    data = await reader.read(struct.calcsize(frmt))
-    return struct.unpack(frmt, data)
+    writer.write(_I.pack(value))
 
 
-async def recv_single_value(reader, frmt):
+def _send_bool(writer, value):
     """
-    Receives a single value from the given reader according to the struct format given and returns
-    it.
+    Sends a single boolean using the given writer.
     """
-    single_value = await recv_formatted_data(reader, frmt)
-    return single_value[0]
+    writer.write(_B.pack(value))
 
 
 async def recv_str(reader):
     """
     Receives a string using the reader. The string must be prefixed with its length and encoded.
     """
-    length = await recv_single_value(reader, '<i')
-    data = await reader.read(length)
+    length = await _recv_i(reader)
+    data = await reader.readexactly(length)
     return data.decode()
 
 
 async def recv_str_list(reader):
     """
-    Receives a list of strings from the reader. The list is prefixed with the length and each string
-    is prefixed with recv_str().
+    Receives a list of strings from the reader as a single framed read. The frame is prefixed
+    with its total payload size, then the list length, then each string prefixed with its
+    length, so the whole list needs just two reads.
     """
-    length = await recv_single_value(reader, "<i")
-    return [await recv_str(reader) for _ in range(length)]
+    total = await _recv_i(reader)
+    view = memoryview(await reader.readexactly(total))
+    count = _I.unpack_from(view, 0)[0]
+    offset = 4
+    strings = []
+    for _ in range(count):
+        length = _I.unpack_from(view, offset)[0]
+        strings.append(str(view[offset+4:offset+4+length], 'utf-8'))
+        offset += 4 + length
+    return strings
 
 
-def send_single_value(writer, frmt, value):
+def send_str(writer, string):
     """
-    Sends a single value using the given writer according to the struct format given.
+    Sends a string using the given writer. The string is encoded then prefixed with the length as a 4-byte
+    integer, all packed into one buffer.
     """
-    writer.write(struct.pack(frmt, value))
+    encoded = string.encode()
+    buf = bytearray(4 + len(encoded))
+    _I.pack_into(buf, 0, len(encoded))
+    buf[4:] = encoded
+    writer.write(buf)
 
 
-def send_str(writer, string):
+def _pack_lenstr(buf, offset, b):
     """
-    Sends a string using the given writer. The string is encoded then prefixed with the length as a 4-byte
-    integer.
+    Packs an already-encoded string into buf at offset, prefixed with its length as a 4-byte
+    integer, and returns the offset just past it.
     """
-    string = string.encode()
-    data = struct.pack('<i', len(string))
-    data += struct.pack(str(len(string)) + 's', string)
-    writer.write(data)
+    _I.pack_into(buf, offset, len(b))
+    buf[offset+4:offset+4+len(b)] = b
+    return offset + 4 + len(b)
 
 
-def send_str_list(writer, strings):
+def str_list_iovs(strings, header=()):
     """
-    Sends a list of strings using given writer. The list is prefixed with its length as a 4-byte
-    integer. Each string is send with send_str().
+    Packs a list of strings into a list of bytes pieces: any integers in header first, then the
+    total payload size, then the list length as a 4-byte integer and each string encoded and
+    prefixed with its length as a 4-byte integer. The pieces can be handed to writer.writelines
+    so the transport gathers them (using sendmsg on Python 3.12+) instead of copying into one
+    contiguous buffer first.
     """
-    length = struct.pack('<i', len(strings))
-    writer.write(length)
-    for string in strings:
-        send_str(writer, string)
+    encoded = [string.encode() for string in strings]
+    total = 4 + sum(4 + len(b) for b in encoded)
+    iovs = [_I.pack(value) for value in header]
+    iovs.append(_I.pack(total))
+    iovs.append(_I.pack(len(encoded)))
+    for b in encoded:
+        iovs.append(_I.pack(len(b)))
+        iovs.append(b)
+    return iovs
 
 
 class ClientTCP():
@@ -78,25 +138,36 @@ class ClientTCP():
     Client that can connect to TCP chat system server. Clients provide a username, and upon a successful 
     connection, they receive recent chat history. Clients are free to chat with others on the server.
     """
-    
+
+    def __init__(self):
+        """
+        Python constructor that creates a dedicated single-thread executor for blocking
+        stdin reads, so they skip the shared pool's dispatch overhead.
+        """
+        self._stdin_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                 thread_name_prefix='stdin')
+
     async def start_chatting(self, reader, writer):
         """
         Connect to the server at addr:port and start chatting in chatroom.
         """
 
         # Initial communication to the server, saying that you are about to send your username
-        # to check if it is valid
-        send_single_value(writer, '<i', 471)
-        await writer.drain()
+        # to check if it is valid. The drain runs as a task so it overlaps with the prompt.
+        loop = asyncio.get_running_loop()
+        _send_i(writer, 471)
+        drain_task = asyncio.create_task(writer.drain())
 
         # Client sends a string, being their username for the chat room, to the server
-        username = input('Enter your username for the chatroom: ')
+        username = await loop.run_in_executor(self._stdin_pool, input,
+                                              'Enter your username for the chatroom: ')
+        await drain_task
         send_str(writer, username)
         await writer.drain()
 
         # If false is received, connection is aborted
         try:
-            status = await recv_single_value(reader, '<?')
+            status = await _recv_bool(reader)
             if status == False:
                 writer.close()
                 return
@@ -106,20 +177,31 @@ class ClientTCP():
             writer.close()
             return
 
-        # Receive an integer and if it follows protocol, receive the history list
-        response = await recv_single_value(reader, '<i')
-        if response == 371:
-            past_messages_num = await recv_single_value(reader, '<i')
-            if past_messages_num == 0:
-                pass
-            else:
-                for message in range(past_messages_num):
-                    past_message = await recv_str_list(reader)
-                    message_data = '%s %s: %s' % (past_message[0], past_message[1], past_message[2])
-                    print(message_data)
+        # Encode the username once so every send can reuse its length-prefixed frame
+        self._username_bytes = username.encode()
+        self._username_frame = _I.pack(len(self._username_bytes)) + self._username_bytes
         return username
 
 
+    def _send_chat_frame(self, writer, str_time, message):
+        """
+        Send a chat message (protocol 472 plus the list of time, username and message) as a
+        single write, reusing the cached length-prefixed username frame.
+        """
+        time_bytes = str_time.encode()
+        message_bytes = message.encode()
+        total = 8 + len(time_bytes) + len(self._username_frame) + 4 + len(message_bytes)
+        buf = bytearray(8 + total)
+        _I.pack_into(buf, 0, 472)
+        _I.pack_into(buf, 4, total)
+        _I.pack_into(buf, 8, 3)
+        offset = _pack_lenstr(buf, 12, time_bytes)
+        buf[offset:offset+len(self._username_frame)] = self._username_frame
+        offset += len(self._username_frame)
+        _pack_lenstr(buf, offset, message_bytes)
+        writer.write(buf)
+
+
     async def send_message(self, writer, username):
         """
         Send a message in the chatroom. Message is sent to the server
@@ -127,25 +209,36 @@ class ClientTCP():
         """
         loop = asyncio.get_running_loop()
         while True:
-            message = await loop.run_in_executor(None, input)
-            local_time = datetime.now()
-            str_time = local_time.strftime("%H:%M:%S")
+            message = await loop.run_in_executor(self._stdin_pool, input)
+            str_time = _now_hms()
             # Client disconnects when 'enter' is pressed in the chat
             if not message:
                 print('You left the chatroom. Goodbye.')
                 return
-            send_single_value(writer, '<i', 472)
-            send_str_list(writer, [str_time, username, message])
+            self._send_chat_frame(writer, str_time, message)
             await writer.drain()
 
 
     async def recv_new_message(self, reader):
         """
-        Receive a new message from the server that was sent from any client in the chatroom.
+        Receive the chat history and then new messages from the server that were sent from any
+        client in the chatroom. Receiving the history here lets it overlap with the user's
+        first prompt in send_message.
         """
+        # Receive an integer and if it follows protocol, receive the history list
+        try:
+            response = await _recv_i(reader)
+            if response == 371:
+                past_messages_num = await _recv_i(reader)
+                for _ in range(past_messages_num):
+                    past_message = await recv_str_list(reader)
+                    message_data = '%s %s: %s' % (past_message[0], past_message[1], past_message[2])
+                    print(message_data)
+        except Exception:
+            return
         while True:
             try:
-                new_message_response = await recv_single_value(reader, '<i')
+                new_message_response = await _recv_i(reader)
             except Exception:
                 break
             else:
@@ -161,6 +254,8 @@ class ClientTCP():
         chatroom, and sending/receiving new messages.
         """
         reader, writer = await asyncio.open_connection('googlecloud.cslab.moravian.edu', 42069)
+        # Disable Nagle so small chat messages go out immediately instead of stalling on ACKs
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         valid_username = await self.start_chatting(reader, writer)
         if not valid_username:
@@ -188,9 +283,12 @@ class ServerTCP():
         Python constructor that initializes lists of writers, current usernames, 
         and recent messages.
         """
-        self.WRITERS = [] # list of all writers currently connected
-        self.USERNAMES_LIST = []  # contains tuples, each one containing the time, username and message
-        self.RECENT_MESSAGES = [] # up to 10 recent chat messages 
+        self.WRITERS = set() # all writers currently connected
+        self.USERNAMES_LIST = []  # contains tuples, each one containing the address and username
+        self._usernames_set = set() # usernames currently taken, for O(1) membership checks
+        self.RECENT_MESSAGES = collections.deque(maxlen=10) # up to 10 recent chat messages
+        self._pending = {} # writer -> buffered broadcast pieces awaiting the next flush
+        self._flush_task = None # task for the pending-broadcast flush, if one is scheduled
 
     def get_history(self):
         """
@@ -200,36 +298,64 @@ class ServerTCP():
 
     def update_history(self, time,username,message):
         """
-        This method has to add the three stings (username, time, text) to the table and remove the oldest one.
+        This method has to add the three stings (username, time, text) to the table; the deque
+        drops the oldest one on its own.
         """
-        new_message = (time, username, message)
-        if len(self.RECENT_MESSAGES) >= 10:
-            self.RECENT_MESSAGES.pop(0)
-        self.RECENT_MESSAGES.append(new_message)
+        self.RECENT_MESSAGES.append((time, username, message))
 
     def send_history(self, writer, history):
         """
         Send the chat history to a new client connecting
         to the chatroom.
         """
-        send_single_value(writer, '<i', 371)
-        send_single_value(writer, '<i', len(history))
-        if len(history) != 0:
-            for message in history:
-                send_str_list(writer, message)
+        iovs = [_I.pack(371), _I.pack(len(history))]
+        for message in history:
+            iovs += str_list_iovs(message)
+        writer.writelines(iovs)
 
     def send_new_message(self, message_info):
         """
         When a new message is received from a client, this function is called to
-        send the message to all clients.
+        send the message to all clients. The frame is buffered per client and flushed
+        after at most COALESCE_MS, so bursts of messages fold into one write per client.
+        Returns the flush task that will write and drain the queued frames.
         """
+        iovs = str_list_iovs(message_info, header=(372,))
         for writer in self.WRITERS:
+            self._pending.setdefault(writer, []).extend(iovs)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_pending())
+        return self._flush_task
+
+    async def _flush_pending(self):
+        """
+        After the coalescing window, flush all buffered broadcast frames with one writelines
+        per client, then drain all clients concurrently so one slow client doesn't stall the
+        rest. Writers whose flush or drain fails are evicted.
+        """
+        await asyncio.sleep(COALESCE_MS / 1000)
+        self._flush_task = None
+        pending, self._pending = self._pending, {}
+        writers = []
+        for writer, pieces in pending.items():
             try:
-                send_single_value(writer, '<i', 372)
-            except KeyboardInterrupt:
-                pass
+                writer.writelines(pieces)
+            except Exception:
+                self._drop_writer(writer)
             else:
-                send_str_list(writer, message_info)
+                writers.append(writer)
+        results = await asyncio.gather(*(w.drain() for w in writers), return_exceptions=True)
+        for writer, result in zip(writers, results):
+            if isinstance(result, Exception):
+                self._drop_writer(writer)
+
+    def _drop_writer(self, writer):
+        """
+        Evict a dead client writer. Closing the transport wakes that client's handler,
+        which removes its username on the way out.
+        """
+        self.WRITERS.discard(writer)
+        writer.close()
 
     async def run_server(self):
         """
@@ -248,32 +374,34 @@ class ServerTCP():
         Handles client requests using the reader and writer that were initialized
         from asyncio.start_server().
         """
-        # Add new writer to the list of writers
-        self.WRITERS.append(writer)
+        # Add new writer to the set of writers
+        self.WRITERS.add(writer)
+        # Disable Nagle so small chat messages go out immediately instead of stalling on ACKs
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         user_info = ()
         while True:
             try:
-                protocol_num = await recv_single_value(reader, '<i')
-            except struct.error:
+                protocol_num = await _recv_i(reader)
+            except (asyncio.IncompleteReadError, struct.error):
                 break
             # New client is joining the chat room
             if protocol_num == 471:
                 client_username = await recv_str(reader)
-                for client_id in self.USERNAMES_LIST:
-                    if client_username == client_id[1]:
-                        send_single_value(writer, '<?', False)
-                        self.WRITERS.remove(writer)
-                        await writer.drain()
-                        writer.close()  # close
-                        return
+                if client_username in self._usernames_set:
+                    _send_bool(writer, False)
+                    self.WRITERS.discard(writer)
+                    await writer.drain()
+                    writer.close()  # close
+                    return
                 # Send True to the client to confirm that the name is available
-                send_single_value(writer, '<?', True)
+                _send_bool(writer, True)
                 await writer.drain()
                 # Add new user to the list of active users
                 addr = writer.get_extra_info('peername')[0]
                 new_user = (addr, client_username)  # address, username
                 user_info = new_user
                 self.USERNAMES_LIST.append(new_user)
+                self._usernames_set.add(client_username)
                 # Send message history to the new client
                 self.send_history(writer, self.get_history())
                 await writer.drain()
@@ -286,15 +414,18 @@ class ServerTCP():
                     break
                 # Send the message to all clients, and update the history
                 else:
-                    self.send_new_message(message_info)
-                    await writer.drain()
+                    # Awaiting the flush task applies backpressure once the frames are
+                    # actually written and drained
+                    await self.send_new_message(message_info)
                     time = message_info[0]
                     username = message_info[1]
                     message = message_info[2]
                     self.update_history(time, username, message)
-        # Remove user and writer from lists, and close the writer 
-        self.USERNAMES_LIST.remove(user_info)
-        self.WRITERS.remove(writer)
+        # Remove user and writer from the collections, and close the writer
+        if user_info:
+            self.USERNAMES_LIST.remove(user_info)
+            self._usernames_set.discard(user_info[1])
+        self.WRITERS.discard(writer)
         writer.close()
         
 
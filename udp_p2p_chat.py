@@ -3,59 +3,167 @@ P2P Chat System using UDP
 """
 
 import asyncio
-from datetime import datetime
-import pickle
+import collections
+import concurrent.futures
+import os
 import socket
+import struct
+import time
+
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 PORT = 5238
 
-def get_ip():
-    """Gets the local IP of the current machine."""
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        try:
-            s.connect(('10.255.255.255', 1)) # random IP address, doesn't have to be reachable
-            return s.getsockname()[0] # get the outgoing IP address on the machine
-        except:
-            return '127.0.0.1'
+_HDR = struct.Struct('<iII')  # protocol number, username length, message count
+_I = struct.Struct('<i')
+_ENTRY = struct.Struct('<BBH')  # time length, username length, message length
+
+MAX_HISTORY_BYTES = 1400  # keep history datagrams under a typical MTU to avoid IP fragmentation
+SESSION_ID_LEN = 16  # random per-process tag prefixed to every datagram to filter our own broadcasts
+
+_last_sec = 0
+_last_str = ''
+
+def _now_hms():
+    """
+    Formats the current time as HH:MM:SS, caching the result for the current second so
+    bursts of messages don't each pay for strftime.
+    """
+    global _last_sec, _last_str
+    sec = int(time.time())
+    if sec != _last_sec:
+        _last_sec = sec
+        _last_str = time.strftime('%H:%M:%S', time.localtime(sec))
+    return _last_str
+
+ChatMessage = collections.namedtuple('ChatMessage', ['protocol_num', 'username', 'message'])
+
+def _truncate_utf8(b, limit):
+    """
+    Truncates encoded utf-8 to at most limit bytes without splitting a character.
+    """
+    if len(b) <= limit:
+        return b
+    return b[:limit].decode('utf-8', 'ignore').encode()
 
 class ChatProtocol(asyncio.DatagramProtocol):
     
     USERNAME = ""
     NEW_USER = True
     BROADCAST = ("255.255.255.255", PORT)
-    RECENT_MESSAGES = []
+    RECENT_MESSAGES = collections.deque(maxlen=10)
     
-    def __init__(self):
-        """Python constructor."""
-        # Set user info and port 
+    def __init__(self, sock):
+        """Python constructor. Takes the raw UDP socket so fire-and-forget sends can skip
+        the transport's Python-level send path."""
+        self._sock = sock
+        # Set user info and port
         self.USERNAME = input("Enter your username for the chatroom: ")
         self.on_con_lost = asyncio.get_running_loop().create_future()
+        self._session_id = os.urandom(SESSION_ID_LEN)  # tags our datagrams so we can skip our own
+        # Dedicated single-thread executor for blocking stdin reads
+        self._stdin_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                 thread_name_prefix='stdin')
         
-    def format_message(self, username, message):
-        """Format a new message to be printed."""
-        current_time = datetime.now().strftime("%H:%M:%S")
-        return '> %s %s: %s' % (current_time, username, message)
-    
+    def format_message(self, msg_time, username, message):
+        """Format a message to be printed."""
+        return '> %s %s: %s' % (msg_time, username, message)
+
     def pack_message(self, protocol_num, username, message):
-        """Pickle a message to be sent."""
-        return pickle.dumps({"protocol_num" : protocol_num, "username" : username, "message" : message})
-    
+        """Pack a single-string message to be sent into the length-prefixed binary schema."""
+        username_bytes = username.encode()
+        message_bytes = message.encode()
+        buf = bytearray(SESSION_ID_LEN + _HDR.size + len(username_bytes) + 4 + len(message_bytes))
+        buf[:SESSION_ID_LEN] = self._session_id
+        _HDR.pack_into(buf, SESSION_ID_LEN, protocol_num, len(username_bytes), 1)
+        offset = SESSION_ID_LEN + _HDR.size
+        buf[offset:offset+len(username_bytes)] = username_bytes
+        offset += len(username_bytes)
+        _I.pack_into(buf, offset, len(message_bytes))
+        buf[offset+4:] = message_bytes
+        return buf
+
+    def pack_history_entry(self, msg_time, username, message):
+        """Pack one (time, username, message) history entry into its <BBH>-prefixed wire
+        form. Entries are stored pre-serialized so sending history never re-encodes them.
+        Fields longer than their length prefix allows are truncated, so remote input can't
+        make the pack throw."""
+        time_b = _truncate_utf8(msg_time.encode(), 255)
+        user_b = _truncate_utf8(username.encode(), 255)
+        msg_b = _truncate_utf8(message.encode(), 65535)
+        return _ENTRY.pack(len(time_b), len(user_b), len(msg_b)) + time_b + user_b + msg_b
+
+    def pack_history(self):
+        """Pack the recent-message history (371) into a compact datagram: the header and our
+        username, then the pre-serialized entries concatenated as-is. The oldest entries are
+        dropped to keep the datagram under MAX_HISTORY_BYTES."""
+        username_bytes = self.USERNAME.encode()
+        entries = []
+        size = SESSION_ID_LEN + _HDR.size + len(username_bytes)
+        for entry in reversed(self.RECENT_MESSAGES):
+            if size + len(entry) > MAX_HISTORY_BYTES:
+                break
+            entries.append(entry)
+            size += len(entry)
+        entries.reverse()
+        buf = bytearray(size)
+        buf[:SESSION_ID_LEN] = self._session_id
+        _HDR.pack_into(buf, SESSION_ID_LEN, 371, len(username_bytes), len(entries))
+        offset = SESSION_ID_LEN + _HDR.size
+        buf[offset:offset+len(username_bytes)] = username_bytes
+        buf[offset+len(username_bytes):] = b''.join(entries)
+        return buf
+
     def unpack_message(self, message_data):
-        """Unpickle a message that was received."""
-        return pickle.loads(message_data)
+        """Unpack a received message into a ChatMessage. History (371) messages carry a list of
+        (time, username, message) tuples, all others a single string."""
+        view = memoryview(message_data)
+        protocol_num, username_len, message_count = _HDR.unpack_from(view, SESSION_ID_LEN)
+        offset = SESSION_ID_LEN + _HDR.size
+        username = str(view[offset:offset+username_len], 'utf-8')
+        offset += username_len
+        if protocol_num == 371:
+            message = []
+            for _ in range(message_count):
+                time_len, user_len, msg_len = _ENTRY.unpack_from(view, offset)
+                offset += _ENTRY.size
+                msg_time = str(view[offset:offset+time_len], 'utf-8')
+                offset += time_len
+                user = str(view[offset:offset+user_len], 'utf-8')
+                offset += user_len
+                msg = str(view[offset:offset+msg_len], 'utf-8')
+                offset += msg_len
+                message.append((msg_time, user, msg))
+        else:
+            length = _I.unpack_from(view, offset)[0]
+            message = str(view[offset+4:offset+4+length], 'utf-8')
+        return ChatMessage(protocol_num, username, message)
         
     def send_history(self, username, addr):
         """Check if username is valid. If valid, send the message history to 
         the new peer. Otherwise, tell the peer that the username is taken."""
         if username != self.USERNAME:
-            response = self.pack_message(371, self.USERNAME, self.RECENT_MESSAGES)
+            response = self.pack_history()
         else:
             response = self.pack_message(370, "", "")
-        self.transport.sendto(response, (addr[0], PORT))
+        self._sendto(response, (addr[0], PORT))
+
+    def _sendto(self, data, addr):
+        """Send a fire-and-forget datagram straight on the raw socket, skipping the
+        transport's Python-level send path; fall back to the transport if the socket
+        would block or the send fails, so errors are handled on asyncio's path."""
+        try:
+            self._sock.sendto(data, addr)
+        except OSError:
+            self.transport.sendto(data, addr)
 
     def connection_made(self, transport):
         """Method called when the connection is initially made."""
-        self.transport = transport        
+        self.transport = transport
         # Starts getting messages as a task in the asyncio loop
         asyncio.create_task(self.get_messages())
 
@@ -67,16 +175,21 @@ class ChatProtocol(asyncio.DatagramProtocol):
         loop = asyncio.get_running_loop()
         # Broadcast new user's name to all other chatters
         new_name = self.pack_message(471, self.USERNAME, "")
-        self.transport.sendto(new_name, self.BROADCAST)
+        self._sendto(new_name, self.BROADCAST)
         while True:
             # Get the message from the user
-            message = await loop.run_in_executor(None, input)
+            message = await loop.run_in_executor(self._stdin_pool, input)
             if not message:
                 self.transport.close()
                 break
             # Broadcast a new message
             new_message = self.pack_message(472, self.USERNAME, message)
-            self.transport.sendto(new_message, self.BROADCAST)
+            self._sendto(new_message, self.BROADCAST)
+            # The session-id filter drops our own broadcast, so echo it locally and
+            # store it in the history ourselves
+            current_time = _now_hms()
+            print(self.format_message(current_time, self.USERNAME, message))
+            self.RECENT_MESSAGES.append(self.pack_history_entry(current_time, self.USERNAME, message))
 
     def connection_lost(self, exc):
         """Method called whenever the transport is closed."""
@@ -84,29 +197,30 @@ class ChatProtocol(asyncio.DatagramProtocol):
 
     def datagram_received(self, data, addr):
         """Method called whenever a datagram is recieved."""
+        # Skip our own broadcasts, which come back tagged with our session id
+        if data[:SESSION_ID_LEN] == self._session_id:
+            return
         # Unpack the user's new message
         message_data = self.unpack_message(data)
-        protocol_num = message_data["protocol_num"]
-        username = message_data["username"]
-        message = message_data["message"]
+        protocol_num = message_data.protocol_num
+        username = message_data.username
+        message = message_data.message
         
         if protocol_num == 370: # If you do not have a valid username
             self.transport.close()
         if protocol_num == 371: # If you have a valid username
             if self.NEW_USER == True:
-                self.RECENT_MESSAGES = message
-                for message in self.RECENT_MESSAGES:
-                    print(message)
+                self.RECENT_MESSAGES = collections.deque(
+                    (self.pack_history_entry(*entry) for entry in message), maxlen=10)
+                for msg_time, user, msg in message:
+                    print(self.format_message(msg_time, user, msg))
                 self.NEW_USER = False
         if protocol_num == 471: # If the message contains the username of a new chatter
-            if addr[0] != get_ip():
-                self.send_history(username, addr)
+            self.send_history(username, addr)
         if protocol_num == 472: # If you receive a new message in the chat
-            new_message = self.format_message(username, message)
-            if len(self.RECENT_MESSAGES) >= 10:
-                self.RECENT_MESSAGES.pop(0)
-            self.RECENT_MESSAGES.append(new_message)
-            print(new_message)
+            current_time = _now_hms()
+            print(self.format_message(current_time, username, message))
+            self.RECENT_MESSAGES.append(self.pack_history_entry(current_time, username, message))
 
     def error_received(self, exc):
         """Method called whenever there is an error with the underlying communication."""
@@ -122,7 +236,8 @@ async def main():
     # Create the transport and protocol with our pre-made socket
     # If not provided, you would instead use local_addr=(...) and/or remote_addr=(...)
     loop = asyncio.get_running_loop()
-    transport, protocol = await loop.create_datagram_endpoint(ChatProtocol, sock=sock)
+    transport, protocol = await loop.create_datagram_endpoint(lambda: ChatProtocol(sock),
+                                                              sock=sock)
 
     # Wait for the connection to be closed/lost
     try: